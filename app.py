@@ -1,3 +1,4 @@
+import html
 import json
 
 import streamlit as st
@@ -7,7 +8,9 @@ from utils import (
     evaluate_expression,
     generate_all_combinations,
     generate_sample,
+    generate_samples,
     render_with_sample,
+    sample_key,
 )
 
 # Minimal single-page app
@@ -57,6 +60,27 @@ with col_load:
         except Exception as e:
             st.sidebar.error(f"❌ Error loading: {str(e)}")
 
+
+@st.fragment
+def _render_variables():
+    """List existing variables with a single delete control."""
+    variables = st.session_state.variables
+    if not variables:
+        return
+    # One markdown element for the list and a single delete control below it
+    st.markdown(
+        "\n".join(f"- **{n}**: {v['rule_description']}" for n, v in variables.items())
+    )
+    del_col1, del_col2 = st.columns([2, 1])
+    to_delete = del_col1.selectbox(
+        "Delete variable", list(variables), key="del_var_name"
+    )
+    if del_col2.button("Delete", key="del_var"):
+        variables.pop(to_delete, None)
+        # full rerun: the editor, preview and template export depend on it
+        st.rerun()
+
+
 c1, c2 = st.columns([1.1, 2])
 
 with c1:
@@ -106,14 +130,7 @@ with c1:
 
     st.markdown("---")
     st.write("Existing")
-    # Collect keys first to avoid "dict changed size during iteration" error
-    var_names = list(st.session_state.variables.keys())
-    for n in var_names:
-        v = st.session_state.variables.get(n)
-        if v:
-            st.write(f"- **{n}**: {v['rule_description']}")
-            if st.button(f"Del {n}", key=f"del_{n}"):
-                del st.session_state.variables[n]
+    _render_variables()
 
 with c2:
     st.header("Editor")
@@ -220,10 +237,7 @@ with c2:
         else:
             st.session_state.multiple_samples = [new_sample]
     if gen_col2.button("Generate Samples"):
-        new_samples = [
-            generate_sample(st.session_state.variables)
-            for _ in range(int(sample_count))
-        ]
+        new_samples = generate_samples(st.session_state.variables, int(sample_count))
         if st.session_state.append_samples:
             existing = st.session_state.get("multiple_samples", [])
             st.session_state.multiple_samples = existing + new_samples
@@ -292,91 +306,125 @@ with c2:
         if rendered_gc:
             st.markdown(f"**Comment:** {rendered_gc}", unsafe_allow_html=True)
 
+
+def _pre(text: str) -> str:
+    """Show text verbatim (like st.code) inside the preview's HTML block."""
+    # newlines as character references: a blank line would otherwise end the
+    # markdown HTML block, while <pre> still displays them as line breaks
+    return f"<pre>{html.escape(text).replace(chr(10), '&#10;')}</pre>"
+
+
+def _render_cell_body(sample: dict, td: dict) -> str:
+    """HTML for one preview cell below its "Sample N" header."""
+    q = render_with_sample(st.session_state.question_template or "", sample)
+
+    # ---- Build question copy text ----
+    question_copy = f"{q}"
+
+    # ---- Build answer/options/comment copy text ----
+    answer_lines = []
+
+    if td.get("type") == "mc":
+        answer_lines.append("Options:")
+        correct = td.get("correct")
+        answer_lines.extend(
+            f"- {'✅ ' if k == correct else ''}{render_with_sample(opt or '', sample)}"
+            for k, opt in enumerate(td.get("options", []))
+        )
+    elif td.get("type") == "tf":
+        answer_lines.append(str(td.get("correct")))
+    elif td.get("type") == "open":
+        ak = td.get("answer_key", "") or ""
+        if ak:
+            if "{{" in ak and "}}" in ak:
+                rendered_answer = render_with_sample(ak, sample)
+            else:
+                rendered_answer = evaluate_expression(ak, sample)
+            answer_lines.append(f"{rendered_answer}")
+        else:
+            answer_lines.append("Answer: (none)")
+
+    # Optional comment
+    comment_from_answer = td.get("comment_from_answer", False)
+    if td.get("include_general"):
+        rendered_gc = None
+        if comment_from_answer and td.get("type") == "open":
+            ak = td.get("answer_key", "") or ""
+            if ak:
+                if "{{" in ak and "}}" in ak:
+                    rendered_gc = render_with_sample(ak, sample)
+                else:
+                    rendered_gc = evaluate_expression(ak, sample)
+        else:
+            gc = td.get("general_comment", "") or ""
+            if gc:
+                rendered_gc = render_with_sample(gc, sample)
+
+        if rendered_gc:
+            answer_lines.append(f"Comment: {rendered_gc}")
+
+    answer_copy = "\n".join(answer_lines)
+
+    # ---- Layout: stack question and answer vertically within the cell ----
+    return (
+        f"<br/><sub>Question</sub>{_pre(question_copy)}"
+        f"<sub>Answer / options</sub>{_pre(answer_copy)}"
+    )
+
+
+def _render_preview():
+    """Render the samples grid from session state as a single HTML block."""
+    samples = st.session_state.get("multiple_samples", [])
+    td = st.session_state.get("template_data", {})
+    cols_per_row = 2
+    cells = []
+    # identical samples (likely with small choice spaces) share one rendered body
+    bodies = {}
+    for sample_idx, sample in enumerate(samples):
+        key = sample_key(sample)
+        body = bodies.get(key) if key is not None else None
+        if body is None:
+            body = _render_cell_body(sample, td)
+            if key is not None:
+                bodies[key] = body
+
+        # ---- Visual separator per sample with alternating background ----
+        bg_color = "#10192f" if sample_idx % 2 == 0 else "#04070f"
+        cells.append(
+            f"<div style='background-color:{bg_color}; padding:8px; "
+            f"border-radius:6px;'>"
+            f"<strong>Sample {sample_idx + 1}</strong>{body}</div>"
+        )
+
+    # One markdown element for the whole grid instead of one per cell
+    grid_html = (
+        f"<div style='display:grid; grid-template-columns:repeat({cols_per_row}, 1fr); "
+        f"gap:8px;'>{''.join(cells)}</div>"
+    )
+    st.markdown(grid_html, unsafe_allow_html=True)
+
+
 # ---------------- Preview Section (full width) ----------------
 st.divider()
 st.subheader("Samples")
 
 samples = st.session_state.get("multiple_samples", [])
 if samples:
-    cols_per_row = 2
-    for i in range(0, len(samples), cols_per_row):
-        row = samples[i : i + cols_per_row]
-        cols = st.columns(cols_per_row)
-        for j, sample in enumerate(row):
-            with cols[j]:
-                sample_idx = i + j
-
-                td = st.session_state.get("template_data", {})
-                q = render_with_sample(
-                    st.session_state.question_template or "", sample
-                )
-
-                # ---- Visual separator per sample with alternating background ----
-                bg_color = "#10192f" if sample_idx % 2 == 0 else "#04070f"
-                st.markdown(
-                    f"<div style='background-color:{bg_color}; padding:8px; "
-                    f"border-radius:6px; margin-bottom:4px;'><strong>Sample {sample_idx + 1}</strong></div>",
-                    unsafe_allow_html=True,
-                )
-
-                # ---- Build question copy text ----
-                question_copy = f"{q}"
-
-                # ---- Build answer/options/comment copy text ----
-                answer_lines = []
-
-                if td.get("type") == "mc":
-                    answer_lines.append("Options:")
-                    for k, opt in enumerate(td.get("options", [])):
-                        rendered_opt = render_with_sample(opt or "", sample)
-                        prefix = "✅ " if k == td.get("correct") else ""
-                        answer_lines.append(f"- {prefix}{rendered_opt}")
-                elif td.get("type") == "tf":
-                    ans = str(td.get("correct"))
-                    answer_lines.append(f"{ans}")
-                elif td.get("type") == "open":
-                    ak = td.get("answer_key", "") or ""
-                    if ak:
-                        if "{{" in ak and "}}" in ak:
-                            rendered_answer = render_with_sample(ak, sample)
-                        else:
-                            rendered_answer = evaluate_expression(ak, sample)
-                        answer_lines.append(f"{rendered_answer}")
-                    else:
-                        answer_lines.append("Answer: (none)")
-
-                # Optional comment
-                comment_from_answer = td.get("comment_from_answer", False)
-                if td.get("include_general"):
-                    rendered_gc = None
-                    if comment_from_answer and td.get("type") == "open":
-                        ak = td.get("answer_key", "") or ""
-                        if ak:
-                            if "{{" in ak and "}}" in ak:
-                                rendered_gc = render_with_sample(ak, sample)
-                            else:
-                                rendered_gc = evaluate_expression(ak, sample)
-                    else:
-                        gc = td.get("general_comment", "") or ""
-                        if gc:
-                            rendered_gc = render_with_sample(gc, sample)
-
-                    if rendered_gc:
-                        answer_lines.append(f"Comment: {rendered_gc}")
-
-                answer_copy = "\n".join(answer_lines) if answer_lines else ""
-
-                # ---- Layout: stack question and answer vertically within the column ----
-                st.caption("Question")
-                st.code(question_copy, language="text")
-
-                st.caption("Answer / options")
-                st.code(answer_copy, language="text")
-    st.download_button(
-        "Export Samples JSON",
-        data=json.dumps(samples, indent=2),
-        file_name="samples.json",
-    )
+    _render_preview()
+    # Serialize only on request; the payload is kept until the samples change
+    prepared = st.session_state.get("samples_json")
+    if prepared and prepared[0] != samples:
+        prepared = st.session_state.samples_json = None
+    if st.button("Prepare Samples JSON"):
+        payload = json.dumps(samples, separators=(",", ":"))
+        prepared = st.session_state.samples_json = (list(samples), payload)
+    if prepared:
+        st.download_button(
+            "Export Samples JSON",
+            data=prepared[1],
+            file_name="samples.json",
+            mime="application/json",
+        )
 else:
     st.info("No samples generated yet. Use the Editor to generate samples.")
 
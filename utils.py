@@ -1,9 +1,36 @@
+import ast
 import math
 import random
 import re
+import string
+from functools import lru_cache
 from itertools import product
 from typing import Any, Dict
 
+import numpy as np
+
+# Precompiled patterns
+
+_TOKEN_RE = re.compile(r"\{\{(.*?)\}\}")
+
+# Markdown-style formatting as a single alternation; the outer named group
+# identifies which rule matched and the first inner group holds the content.
+_MD_RE = re.compile(
+    r"(?P<strike>~~([^~]+)~~)"
+    r"|(?P<mark>==([^=]+)==)"
+    r"|(?P<emstrong>\*\*\*([^*]+)\*\*\*|___([^_]+)___)"
+    r"|(?P<strong>\*\*([^*]+)\*\*|__([^_]+)__)"
+    r"|(?P<em>(?<!\*)\*(?!\*)((?:[^*]|\*\*[^*]+\*\*)+?)\*(?!\*)"
+    r"|(?<!_)_(?!_)((?:[^_]|__[^_]+__)+?)_(?!_))"
+)
+_MD_TAGS = {
+    "strike": ("<s>", "</s>"),
+    "mark": ("<mark>", "</mark>"),
+    "emstrong": ("<em><strong>", "</strong></em>"),
+    "strong": ("<strong>", "</strong>"),
+    "em": ("<em>", "</em>"),
+}
+
 # Helpers
 
 
@@ -13,76 +40,276 @@ def _to_number(v: Any):
     try:
         if isinstance(v, str):
             s = v.strip()
-            # support binary/hex/octal with 0b/0x/0o prefixes and plain ints
-            try:
-                return int(s, 0)
-            except Exception:
-                pass
+            # dispatch on the shape of the string instead of raising on non-ints
+            core = s[1:] if s.startswith(("+", "-")) else s
+            if core.isdigit() and (core[0] != "0" or not core.strip("0")):
+                return int(s)
+            # 0b/0x/0o prefixes, underscores and zero-padded digits: let
+            # int(s, 0) decide as before ("1_000" -> 1000, "010" -> 10.0)
+            if "_" in core or core.isdigit() or core[:2].lower() in ("0x", "0b", "0o"):
+                try:
+                    return int(s, 0)
+                except ValueError:
+                    pass
             # fallback to float
             return float(s)
     except Exception:
         return v
 
 
+# Helper to select a value from a mapping based on a key.
+def _select(key, mapping, default=None):
+    """Select value by key from a dict or iterable of pairs.
+
+    Examples:
+      select(var, {'f':'t0','g':'t1'}, 'default')
+      select(var, [('f','t0'),('g','t1')], 'default')
+    """
+    if mapping is None:
+        return default
+    if isinstance(mapping, dict):
+        return mapping.get(key, default)
+    try:
+        for k, v in mapping:
+            if k == key:
+                return v
+    except Exception:
+        pass
+    return default
+
+
+# Expose a small set of safe Python helpers for conversions and simple ops
+_SAFE_BUILTINS = {
+    "int": int,
+    "float": float,
+    "str": str,
+    "bin": bin,
+    "hex": hex,
+    "oct": oct,
+    "round": round,
+    "abs": abs,
+    "pow": pow,
+    "sum": sum,
+    "min": min,
+    "max": max,
+    "len": len,
+    "sorted": sorted,
+    "range": range,
+    "list": list,
+    "tuple": tuple,
+    "dict": dict,
+}
+
+# eval globals, built once: math funcs + safe helpers + select/case.
+# Builtins are restricted to the small set injected here.
+_BASE_GLOBALS = {
+    **{k: getattr(math, k) for k in dir(math) if not k.startswith("__")},
+    **_SAFE_BUILTINS,
+    "select": _select,
+    "case": _select,
+    "__builtins__": {},
+}
+
+
+# AST node types an expression may contain; anything else (statements,
+# await/yield, ...) is rejected before compiling.
+_ALLOWED_NODES = {
+    ast.Expression,
+    ast.Constant,
+    ast.Name,
+    ast.Load,
+    ast.Store,
+    ast.BinOp,
+    ast.UnaryOp,
+    ast.BoolOp,
+    ast.Compare,
+    ast.IfExp,
+    ast.Call,
+    ast.keyword,
+    ast.Attribute,
+    ast.Subscript,
+    ast.Slice,
+    ast.List,
+    ast.Tuple,
+    ast.Dict,
+    ast.Set,
+    ast.Starred,
+    ast.NamedExpr,
+    ast.Lambda,
+    ast.arguments,
+    ast.arg,
+    ast.ListComp,
+    ast.SetComp,
+    ast.DictComp,
+    ast.GeneratorExp,
+    ast.comprehension,
+    ast.JoinedStr,
+    ast.FormattedValue,
+    # operators
+    ast.Add,
+    ast.Sub,
+    ast.Mult,
+    ast.Div,
+    ast.FloorDiv,
+    ast.Mod,
+    ast.Pow,
+    ast.LShift,
+    ast.RShift,
+    ast.BitOr,
+    ast.BitXor,
+    ast.BitAnd,
+    ast.MatMult,
+    ast.UAdd,
+    ast.USub,
+    ast.Not,
+    ast.Invert,
+    ast.And,
+    ast.Or,
+    ast.Eq,
+    ast.NotEq,
+    ast.Lt,
+    ast.LtE,
+    ast.Gt,
+    ast.GtE,
+    ast.Is,
+    ast.IsNot,
+    ast.In,
+    ast.NotIn,
+}
+
+# The only attributes an expression may read. Attribute access is how an
+# expression escapes the sandbox (generator/frame/code objects, __globals__,
+# str.format field lookups), so this is an allow-list rather than a filter.
+_ALLOWED_ATTRS = {
+    # str
+    "upper",
+    "lower",
+    "title",
+    "capitalize",
+    "strip",
+    "lstrip",
+    "rstrip",
+    "zfill",
+    "ljust",
+    "rjust",
+    "center",
+    "split",
+    "join",
+    "replace",
+    "startswith",
+    "endswith",
+    "count",
+    "find",
+    "index",
+    "isdigit",
+    # dict
+    "get",
+    "keys",
+    "values",
+    "items",
+    # numbers
+    "real",
+    "imag",
+    "bit_length",
+    "is_integer",
+    "hex",
+    "conjugate",
+    "as_integer_ratio",
+}
+
+_FORMATTER = string.Formatter()
+
+
+def _is_safe_format(fmt: str) -> bool:
+    """True if a str.format template only uses plain field names.
+
+    Field names with "." or "[" look up attributes/items on the arguments
+    (e.g. "{0.__globals__}"), so they are refused, including inside nested
+    format specs such as "{0:{1.x}}".
+    """
+    try:
+        for _, field, spec, _ in _FORMATTER.parse(fmt):
+            if field and ("." in field or "[" in field):
+                return False
+            if spec and not _is_safe_format(spec):
+                return False
+    except ValueError:
+        return False
+    return True
+
+
+@lru_cache(maxsize=512)
+def _compile_expr(expr: str):
+    """Parse and validate an expression once, then reuse the code object.
+
+    Raises ValueError for constructs outside _ALLOWED_NODES, attributes
+    outside _ALLOWED_ATTRS, and dunder names or "_"-prefixed string keys.
+    `.format` is allowed only on a string literal with plain field names.
+
+    Known escapes are rejected, common expressions keep working:
+
+    >>> _eval_expr("[y.gi_frame for y in (x for x in [1])]", {})
+    ('<err>', True)
+    >>> _eval_expr("().__class__", {})
+    ('<err>', True)
+    >>> _eval_expr("'{0.__globals__}'.format(select)", {})
+    ('<err>', True)
+    >>> _eval_expr("'{0:{1.real}}'.format(1, 2)", {})
+    ('<err>', True)
+    >>> _eval_expr("s.format(select)", {"s": "{0.__globals__}"})
+    ('<err>', True)
+    >>> _eval_expr("d['__x']", {"d": {}})
+    ('<err>', True)
+    >>> _eval_expr("'{:.2f}'.format(a)", {"a": "7"})
+    ('7.00', False)
+    >>> _eval_expr("(a / 4).hex()", {"a": "2"})
+    ('0x1.0000000000000p-1', False)
+    >>> _eval_expr("sorted([3, 1, 2], key=lambda v: -v)", {})
+    ([3, 2, 1], False)
+    >>> _eval_expr("max(*[3, 1]), {k: 1 for k in 'ab'}, str(c).upper()", {"c": "f"})
+    ((3, {'a': 1, 'b': 1}, 'F'), False)
+    """
+    tree = ast.parse(expr, "<tmpl>", "eval")
+    for node in ast.walk(tree):
+        if type(node) not in _ALLOWED_NODES:
+            raise ValueError(f"Unsupported expression: {type(node).__name__}")
+        if isinstance(node, ast.Attribute) and node.attr == "format":
+            template = node.value
+            if not (
+                isinstance(template, ast.Constant)
+                and isinstance(template.value, str)
+                and _is_safe_format(template.value)
+            ):
+                raise ValueError("Unsupported format template")
+        elif isinstance(node, ast.Attribute) and node.attr not in _ALLOWED_ATTRS:
+            raise ValueError(f"Unsupported attribute: {node.attr}")
+        if isinstance(node, (ast.Name, ast.arg)):
+            name = node.id if isinstance(node, ast.Name) else node.arg
+            if name.startswith("__"):
+                raise ValueError(f"Unsupported name: {name}")
+        if (
+            isinstance(node, ast.Subscript)
+            and isinstance(node.slice, ast.Constant)
+            and isinstance(node.slice.value, str)
+            and node.slice.value.startswith("_")
+        ):
+            raise ValueError(f"Unsupported key: {node.slice.value!r}")
+    return compile(tree, "<tmpl>", "eval")
+
+
 def _eval_expr(expr: str, context: Dict[str, Any]):
     """Evaluate an expression using context variables and math funcs.
     Returns (value, error_flag)
     """
-    # build eval locals: math funcs + context vars (coerced when possible)
-    locals_ = {k: getattr(math, k) for k in dir(math) if not k.startswith("__")}
-    for k, v in context.items():
-        locals_[k] = _to_number(v)
-
-    # Expose a small set of safe Python helpers for conversions and simple ops
-    safe_builtins = {
-        "int": int,
-        "float": float,
-        "str": str,
-        "bin": bin,
-        "hex": hex,
-        "oct": oct,
-        "round": round,
-        "abs": abs,
-        "pow": pow,
-        "sum": sum,
-        "min": min,
-        "max": max,
-        "len": len,
-        "sorted": sorted,
-        "range": range,
-        "list": list,
-        "tuple": tuple,
-        "dict": dict,
+    # per-call locals only hold the context vars (coerced when possible);
+    # generated ints/floats skip the _to_number call entirely
+    locals_ = {
+        k: v if type(v) is int or type(v) is float else _to_number(v)
+        for k, v in context.items()
     }
-    locals_.update(safe_builtins)
-
-    # Helper to select a value from a mapping based on a key.
-    def select(key, mapping, default=None):
-        """Select value by key from a dict or iterable of pairs.
-
-        Examples:
-          select(var, {'f':'t0','g':'t1'}, 'default')
-          select(var, [('f','t0'),('g','t1')], 'default')
-        """
-        if mapping is None:
-            return default
-        if isinstance(mapping, dict):
-            return mapping.get(key, default)
-        try:
-            for k, v in mapping:
-                if k == key:
-                    return v
-        except Exception:
-            pass
-        return default
-
-    # expose select
-    locals_["select"] = select
-    locals_["case"] = select
 
     try:
-        # restrict builtins but allow the small set we injected in locals_
-        val = eval(expr, {"__builtins__": {}}, locals_)
+        val = eval(_compile_expr(expr), _BASE_GLOBALS, locals_)
         return val, False
     except Exception:
         return "<err>", True
@@ -135,13 +362,23 @@ def generate_value(
         return "<err>"
 
 
-def generate_sample(variables: Dict[str, Any]) -> Dict[str, Any]:
-    """Attempt to generate a consistent sample for all variables."""
+def generate_sample(
+    variables: Dict[str, Any], preset: Dict[str, Any] = None
+) -> Dict[str, Any]:
+    """Attempt to generate a consistent sample for all variables.
+
+    Values in `preset` are used in place of generating those variables; they
+    are filled in at each variable's turn so the sample keeps definition order.
+    """
+    preset = preset or {}
     sample: Dict[str, Any] = {}
     for _ in range(5):
         for name, vdef in variables.items():
             if name in sample:
                 continue
+            if name in preset:
+                sample[name] = preset[name]
+                continue
             val = generate_value(name, vdef, sample)
             if val == "<err>":
                 continue
@@ -151,6 +388,50 @@ def generate_sample(variables: Dict[str, Any]) -> Dict[str, Any]:
     return sample
 
 
+def _batch_random_numbers(rule_data: Dict[str, Any], n: int, np_rng) -> list:
+    """Draw `n` values for a random_number rule in one numpy call."""
+    mn = int(rule_data.get("min", 1))
+    mx = int(rule_data.get("max", 10))
+    step = int(rule_data.get("step", 1))
+    span = len(range(mn, mx + 1, step)) if step > 1 else 0
+    if not span:
+        return np_rng.integers(mn, mx, size=n, endpoint=True).tolist()
+    return (mn + step * np_rng.integers(0, span, size=n)).tolist()
+
+
+# below this many samples, creating the numpy generator costs more than the
+# per-sample random.randint calls it replaces
+_BATCH_MIN_SAMPLES = 16
+
+
+def generate_samples(variables: Dict[str, Any], count: int) -> list:
+    """Generate `count` samples, drawing random_number variables in batch.
+
+    random_number values don't depend on other variables, so for larger
+    counts they are drawn up front (one numpy call per variable, seeded
+    from `random`) and passed to generate_sample as presets.
+    """
+    if count < _BATCH_MIN_SAMPLES:
+        return [generate_sample(variables) for _ in range(count)]
+
+    np_rng = np.random.default_rng(random.getrandbits(64))
+    drawn = {}
+    for name, vdef in variables.items():
+        rule_data = vdef.get("rule_data", {})
+        if rule_data.get("type") != "random_number":
+            continue
+        try:
+            drawn[name] = _batch_random_numbers(rule_data, count, np_rng)
+        except Exception:
+            # leave bad rules to generate_value, which reports them as "?"
+            pass
+
+    return [
+        generate_sample(variables, {n: v[i] for n, v in drawn.items()})
+        for i in range(count)
+    ]
+
+
 def generate_all_combinations(variables: Dict[str, Any]) -> list:
     """Generate all possible combinations for random choice variables.
 
@@ -179,10 +460,8 @@ def generate_all_combinations(variables: Dict[str, Any]) -> list:
 
     all_samples = []
     for combo in product(*choice_lists):
-        sample = {}
         # Add the choice values
-        for i, name in enumerate(choice_names):
-            sample[name] = combo[i]
+        sample = dict(zip(choice_names, combo))
 
         # For other variables, generate values based on what we have so far
         for name, vdef in other_vars.items():
@@ -197,6 +476,13 @@ def generate_all_combinations(variables: Dict[str, Any]) -> list:
     return all_samples
 
 
+def _md_repl(m) -> str:
+    open_tag, close_tag = _MD_TAGS[m.lastgroup]
+    inner = next(g for g in m.groups()[m.lastindex :] if g is not None)
+    # content may itself carry other markers, e.g. ~~**text**~~
+    return f"{open_tag}{format_text(inner)}{close_tag}"
+
+
 def format_text(text: str) -> str:
     """Convert markdown-style formatting to HTML.
 
@@ -205,29 +491,28 @@ def format_text(text: str) -> str:
       - *text* or _text_ → <em>text</em>
       - ~~text~~ → <s>text</s> (strikethrough)
       - ==text== → <mark>text</mark> (highlight)
+      - ***text*** or ___text___ → <em><strong>text</strong></em>
       - HTML tags are passed through as-is
 
-    Order matters: apply in order to avoid double-processing.
+    All rules are matched in one scan; nested markers are formatted recursively.
     """
     if not text:
         return text
 
-    # Strikethrough: ~~text~~
-    text = re.sub(r"~~([^~]+)~~", r"<s>\1</s>", text)
+    return _MD_RE.sub(_md_repl, text)
 
-    # Highlight: ==text==
-    text = re.sub(r"==([^=]+)==", r"<mark>\1</mark>", text)
 
-    # Bold: **text** or __text__
-    text = re.sub(r"\*\*([^*]+)\*\*", r"<strong>\1</strong>", text)
-    text = re.sub(r"__([^_]+)__", r"<strong>\1</strong>", text)
+def sample_key(sample: Dict[str, Any]):
+    """Hashable key identifying a sample, or None if a value is unhashable.
 
-    # Italic: *text* or _text_ (but not __text__ which is bold, and not inside **text**)
-    # Use negative lookbehind/lookahead to avoid matching bold markers
-    text = re.sub(r"(?<!\*)\*(?!\*)([^*]+?)\*(?!\*)", r"<em>\1</em>", text)
-    text = re.sub(r"(?<!_)_(?!_)([^_]+?)_(?!_)", r"<em>\1</em>", text)
-
-    return text
+    The value type is part of the key so 1, 1.0 and True don't collide.
+    """
+    key = tuple(sorted((k, type(v), v) for k, v in sample.items()))
+    try:
+        hash(key)
+    except TypeError:
+        return None
+    return key
 
 
 def render_with_sample(text: str, sample: Dict[str, Any]) -> str:
@@ -238,7 +523,62 @@ def render_with_sample(text: str, sample: Dict[str, Any]) -> str:
       - {{ num * 2 }} → evaluated expression using sample values
 
     Also supports markdown formatting: **bold**, *italic*, ~~strike~~, ==highlight==
+
+    Results are memoized per (text, sample); samples with unhashable values
+    are rendered directly.
     """
+    if not text:
+        return text
+    key = sample_key(sample)
+    if key is None:
+        return _render_with_sample(text, sample)
+    return _render_cached(text, key)
+
+
+@lru_cache(maxsize=2048)
+def _render_cached(text: str, key: tuple) -> str:
+    return _render_with_sample(text, {k: v for k, _, v in key})
+
+
+class _SampleLookup(dict):
+    """format_map mapping that resolves names missing from the sample the
+    way the regex path does: evaluate them (e.g. `pi`) or keep `{{name}}`."""
+
+    def __missing__(self, key):
+        val, err = _eval_expr(key, self)
+        if err:
+            return f"{{{{{key}}}}}"
+        return val
+
+
+@lru_cache(maxsize=512)
+def _to_format(text: str):
+    """Convert a template to a str.format string, e.g. "{{a}} + {{ b }}" ->
+    "{a} + {b}". Returns None if any token is not a bare identifier."""
+    parts = []
+    pos = 0
+    for m in _TOKEN_RE.finditer(text):
+        token = m.group(1).strip()
+        if not token.isidentifier():
+            return None
+        literal = text[pos : m.start()]
+        parts.append(literal.replace("{", "{{").replace("}", "}}"))
+        parts.append(f"{{{token}}}")
+        pos = m.end()
+    parts.append(text[pos:].replace("{", "{{").replace("}", "}}"))
+    return "".join(parts)
+
+
+def _render_with_sample(text: str, sample: Dict[str, Any]) -> str:
+    # fast path: nothing to substitute, only formatting applies
+    if "{{" not in text:
+        return format_text(text)
+
+    # common case: every token is a plain identifier, so the template can be
+    # rendered by str.format_map in C instead of a per-match Python callback
+    fmt = _to_format(text)
+    if fmt is not None:
+        return format_text(fmt.format_map(_SampleLookup(sample)))
 
     def repl(m):
         token = m.group(1).strip()
@@ -251,7 +591,7 @@ def render_with_sample(text: str, sample: Dict[str, Any]) -> str:
             return f"{{{{{token}}}}}"
         return str(val)
 
-    rendered = re.sub(r"\{\{(.*?)\}\}", repl, text)
+    rendered = _TOKEN_RE.sub(repl, text)
     # Apply formatting after variable substitution
     return format_text(rendered)
 